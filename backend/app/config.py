@@ -20,6 +20,21 @@ class Settings(BaseSettings):
     upload_dir: str = "uploads"
     anthropic_api_key: str = ""
     anthropic_model: str = "claude-sonnet-4-20250514"
+    anthropic_base_url: str = ""
+    # Pre-flight budgeting: context limits, output bounds and pricing used for estimates.
+    context_window_tokens: int = 200_000
+    long_context_model: str = ""
+    long_context_window_tokens: int = 1_000_000
+    max_output_tokens: int = 8192
+    min_output_tokens: int = 1024
+    input_cost_per_mtok: float = 3.0
+    output_cost_per_mtok: float = 15.0
+    input_tokens_per_second: float = 20_000.0
+    output_tokens_per_second: float = 60.0
+    long_context_input_cost_per_mtok: float = 6.0
+    long_context_output_cost_per_mtok: float = 22.5
+    long_context_input_tokens_per_second: float = 20_000.0
+    long_context_output_tokens_per_second: float = 60.0
     db_path: str = "signaldrift.db"
 
     @property
@@ -28,6 +43,11 @@ class Settings(BaseSettings):
         p = Path(self.upload_dir)
         return p if p.is_absolute() else _BACKEND_DIR / p
 
+    @property
+    def document_cache_path(self) -> Path:
+        """Directory for locally cached encoded document payloads, kept inside the upload dir."""
+        return self.upload_path / ".cache"
+
     @property
     def cors_origin_list(self) -> list[str]:
         """Parse comma-separated CORS origins into a list."""
@@ -1,4 +1,8 @@
+import asyncio
+import sqlite3
+import time
 import uuid
+from collections.abc import AsyncIterator
 from datetime import datetime, UTC
 from pathlib import Path
 
@@ -79,43 +83,161 @@ def _db_path() -> str:
     return str(path)
 
 
-async def get_db() -> aiosqlite.Connection:
-    db = await aiosqlite.connect(_db_path())
+MIGRATION_LOCK_TIMEOUT_S = 60.0
+
+
+async def get_db(timeout: float = 5.0) -> aiosqlite.Connection:
+    db = await aiosqlite.connect(_db_path(), timeout=timeout)
     db.row_factory = aiosqlite.Row
-    await db.execute("PRAGMA journal_mode=WAL")
     await db.execute("PRAGMA foreign_keys=ON")
     return db
 
 
+# -- Migrations --
+#
+# Each migration runs exactly once, in version order, and is recorded in schema_version.
+# Append new migrations to MIGRATIONS; never edit one that has shipped. Statements use
+# IF NOT EXISTS / column checks so databases created before versioning adopt cleanly.
+
+async def _m001_baseline(db: aiosqlite.Connection) -> None:
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS prompts (
+            id TEXT PRIMARY KEY,
+            text TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )""")
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS runs (
+            id TEXT PRIMARY KEY,
+            prompt_id TEXT NOT NULL REFERENCES prompts(id),
+            document_filename TEXT NOT NULL,
+            model TEXT NOT NULL,
+            output TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            error_message TEXT,
+            duration_ms INTEGER,
+            created_at TEXT NOT NULL
+        )""")
+    cursor = await db.execute("SELECT COUNT(*) FROM prompts")
+    row = await cursor.fetchone()
+    if row[0] == 0:
+        await db.execute(
+            "INSERT INTO prompts (id, text, created_at) VALUES (?, ?, ?)",
+            (_new_id(), DEFAULT_PROMPT, _now()),
+        )
+
+
+async def _m002_document_files(db: aiosqlite.Connection) -> None:
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS document_files (
+            document_filename TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            uploaded_at TEXT NOT NULL
+        )""")
+
+
+async def _m003_token_budget(db: aiosqlite.Connection) -> None:
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS token_counts (
+            document_hash TEXT NOT NULL,
+            prompt_hash TEXT NOT NULL,
+            model TEXT NOT NULL,
+            input_tokens INTEGER NOT NULL,
+            created_at TEXT NOT NULL,
+            PRIMARY KEY (document_hash, prompt_hash, model)
+        )""")
+    await _add_missing_columns(db, "runs", {
+        "input_tokens": "INTEGER",
+        "max_tokens": "INTEGER",
+        "stop_reason": "TEXT",
+        "truncated": "INTEGER NOT NULL DEFAULT 0",
+    })
+
+
+async def _m004_run_indexes(db: aiosqlite.Connection) -> None:
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_runs_created_at ON runs(created_at)")
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_runs_document_filename "
+        "ON runs(document_filename, created_at)"
+    )
+
+
+MIGRATIONS = [
+    (1, "baseline", _m001_baseline),
+    (2, "document_files", _m002_document_files),
+    (3, "token_budget", _m003_token_budget),
+    (4, "run_indexes", _m004_run_indexes),
+]
+
+
+async def _add_missing_columns(db: aiosqlite.Connection, table: str,
+                               columns: dict[str, str]) -> None:
+    """Add columns that may already exist on databases created before versioning."""
+    cursor = await db.execute(f"PRAGMA table_info({table})")
+    existing = {row["name"] for row in await cursor.fetchall()}
+    for name, ddl in columns.items():
+        if name not in existing:
+            await db.execute(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}")
+
+
+async def schema_version(db: aiosqlite.Connection) -> int:
+    cursor = await db.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    row = await cursor.fetchone()
+    return row[0]
+
+
+async def _enable_wal(db: aiosqlite.Connection) -> None:
+    """Switch the database to WAL mode, which persists in the file, so it is done once here.
+
+    SQLite does not apply the busy timeout to a journal mode change, so retry while other
+    workers briefly hold the database.
+    """
+    deadline = time.monotonic() + MIGRATION_LOCK_TIMEOUT_S
+    while True:
+        try:
+            await db.execute("PRAGMA journal_mode=WAL")
+            return
+        except sqlite3.OperationalError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.05)
+
+
 async def init_db() -> None:
-    db = await get_db()
+    """Apply pending migrations.
+
+    BEGIN IMMEDIATE takes SQLite's write lock before the version is read, so when several
+    workers start together one migrates and the rest wait, then find nothing to do.
+    """
+    db = await get_db(timeout=MIGRATION_LOCK_TIMEOUT_S)
     try:
-        await db.executescript("""
-            CREATE TABLE IF NOT EXISTS prompts (
-                id TEXT PRIMARY KEY,
-                text TEXT NOT NULL,
-                created_at TEXT NOT NULL
-            );
-            CREATE TABLE IF NOT EXISTS runs (
-                id TEXT PRIMARY KEY,
-                prompt_id TEXT NOT NULL REFERENCES prompts(id),
-                document_filename TEXT NOT NULL,
-                model TEXT NOT NULL,
-                output TEXT,
-                status TEXT NOT NULL DEFAULT 'pending',
-                error_message TEXT,
-                duration_ms INTEGER,
-                created_at TEXT NOT NULL
-            );
-        """)
-        cursor = await db.execute("SELECT COUNT(*) FROM prompts")
-        row = await cursor.fetchone()
-        if row[0] == 0:
-            await db.execute(
-                "INSERT INTO prompts (id, text, created_at) VALUES (?, ?, ?)",
-                (_new_id(), DEFAULT_PROMPT, _now()),
-            )
-        await db.commit()
+        # Everything, including creating schema_version, happens under the write lock: a
+        # separate read-then-write transaction can fail with "database is locked" when another
+        # worker holds the lock, because SQLite refuses to wait on a lock upgrade.
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TEXT NOT NULL
+                )""")
+            current = await schema_version(db)
+            for version, name, migrate in MIGRATIONS:
+                if version > current:
+                    await migrate(db)
+                    await db.execute(
+                        "INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)",
+                        (version, name, _now()),
+                    )
+            await db.commit()
+        except BaseException:
+            await db.rollback()
+            raise
+
+        await _enable_wal(db)
     finally:
         await db.close()
 
@@ -166,7 +288,8 @@ async def create_prompt(text: str) -> dict:
 
 # -- Run CRUD --
 
-async def create_run(prompt_id: str, document_filename: str, model: str) -> dict:
+async def create_run(prompt_id: str, document_filename: str, model: str, *,
+                     input_tokens: int | None = None, max_tokens: int | None = None) -> dict:
     run = {
         "id": _new_id(),
         "prompt_id": prompt_id,
@@ -177,14 +300,20 @@ async def create_run(prompt_id: str, document_filename: str, model: str) -> dict
         "error_message": None,
         "duration_ms": None,
         "created_at": _now(),
+        "input_tokens": input_tokens,
+        "max_tokens": max_tokens,
+        "stop_reason": None,
+        "truncated": 0,
     }
     db = await get_db()
     try:
         await db.execute(
-            """INSERT INTO runs (id, prompt_id, document_filename, model, output, status, error_message, duration_ms, created_at)
-               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            """INSERT INTO runs (id, prompt_id, document_filename, model, output, status, error_message, duration_ms, created_at,
+                                input_tokens, max_tokens)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
             (run["id"], run["prompt_id"], run["document_filename"], run["model"],
-             run["output"], run["status"], run["error_message"], run["duration_ms"], run["created_at"]),
+             run["output"], run["status"], run["error_message"], run["duration_ms"],
+             run["created_at"], run["input_tokens"], run["max_tokens"]),
         )
         await db.commit()
         return run
@@ -193,12 +322,15 @@ async def create_run(prompt_id: str, document_filename: str, model: str) -> dict
 
 
 async def update_run(run_id: str, *, status: str, output: str | None = None,
-                     error_message: str | None = None, duration_ms: int | None = None) -> None:
+                     error_message: str | None = None, duration_ms: int | None = None,
+                     stop_reason: str | None = None, truncated: bool = False) -> None:
     db = await get_db()
     try:
         await db.execute(
-            "UPDATE runs SET status = ?, output = ?, error_message = ?, duration_ms = ? WHERE id = ?",
-            (status, output, error_message, duration_ms, run_id),
+            """UPDATE runs SET status = ?, output = ?, error_message = ?, duration_ms = ?,
+                               stop_reason = ?, truncated = ?
+               WHERE id = ?""",
+            (status, output, error_message, duration_ms, stop_reason, int(truncated), run_id),
         )
         await db.commit()
     finally:
@@ -241,3 +373,103 @@ async def list_runs(document_filename: str | None = None) -> list[dict]:
         return [dict(r) for r in rows]
     finally:
         await db.close()
+
+
+async def iter_runs(*, created_from: str | None = None, created_to: str | None = None,
+                    document_filename: str | None = None, prompt_id: str | None = None,
+                    status: str | None = None, batch_size: int = 500) -> AsyncIterator[list[dict]]:
+    """Yield matching runs oldest first, in batches fetched from a single open cursor.
+
+    The connection stays open while the caller consumes batches, so memory use is bounded
+    by batch_size rather than by the number of runs.
+    """
+    filters = {
+        "created_at >= ?": created_from,
+        "created_at < ?": created_to,
+        "document_filename = ?": document_filename,
+        "prompt_id = ?": prompt_id,
+        "status = ?": status,
+    }
+    clauses = [clause for clause, value in filters.items() if value is not None]
+    params = [value for value in filters.values() if value is not None]
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+
+    db = await get_db()
+    try:
+        cursor = await db.execute(f"SELECT * FROM runs {where} ORDER BY created_at, id", params)
+        while rows := await cursor.fetchmany(batch_size):
+            yield [dict(r) for r in rows]
+    finally:
+        await db.close()
+
+
+# -- Provider file references --
+
+async def get_document_file(document_filename: str) -> dict | None:
+    db = await get_db()
+    try:
+        cursor = await db.execute(
+            "SELECT * FROM document_files WHERE document_filename = ?", (document_filename,)
+        )
+        row = await cursor.fetchone()
+        return dict(row) if row else None
+    finally:
+        await db.close()
+
+
+async def save_document_file(
+    document_filename: str, file_id: str, size: int, mtime_ns: int
+) -> None:
+    db = await get_db()
+    try:
+        await db.execute(
+            """INSERT OR REPLACE INTO document_files
+                   (document_filename, file_id, size, mtime_ns, uploaded_at)
+               VALUES (?, ?, ?, ?, ?)""",
+            (document_filename, file_id, size, mtime_ns, _now()),
+        )
+        await db.commit()
+    finally:
+        await db.close()
+
+
+async def delete_document_file(document_filename: str) -> None:
+    db = await get_db()
+    try:
+        await db.execute(
+            "DELETE FROM document_files WHERE document_filename = ?", (document_filename,)
+        )
+        await db.commit()
+    finally:
+        await db.close()
+
+
+# -- Token counts --
+
+async def get_token_count(document_hash: str, prompt_hash: str, model: str) -> int | None:
+    db = await get_db()
+    try:
+        cursor = await db.execute(
+            """SELECT input_tokens FROM token_counts
+               WHERE document_hash = ? AND prompt_hash = ? AND model = ?""",
+            (document_hash, prompt_hash, model),
+        )
+        row = await cursor.fetchone()
+        return row[0] if row else None
+    finally:
+        await db.close()
+
+
+async def save_token_count(document_hash: str, prompt_hash: str, model: str,
+                           input_tokens: int) -> None:
+    db = await get_db()
+    try:
+        await db.execute(
+            """INSERT OR REPLACE INTO token_counts
+                   (document_hash, prompt_hash, model, input_tokens, created_at)
+               VALUES (?, ?, ?, ?, ?)""",
+            (document_hash, prompt_hash, model, input_tokens, _now()),
+        )
+        await db.commit()
+    finally:
+        await db.close()
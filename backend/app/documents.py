@@ -0,0 +1,192 @@
+import base64
+import hashlib
+import logging
+import os
+import tempfile
+from functools import lru_cache
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from app.config import settings
+from app.database import delete_document_file, get_document_file, save_document_file
+
+if TYPE_CHECKING:
+    import anthropic
+
+logger = logging.getLogger(__name__)
+
+FILES_API_BETA = "files-api-2025-04-14"
+
+
+def _cached_payload_path(file_path: Path, size: int, mtime_ns: int) -> Path:
+    return settings.document_cache_path / f"{file_path.name}.{size}.{mtime_ns}.b64"
+
+
+def _cached_payloads(document_filename: str) -> list[Path]:
+    cache_dir = settings.document_cache_path
+    if not cache_dir.exists():
+        return []
+    return [
+        f for f in cache_dir.iterdir()
+        if f.suffix == ".b64" and f.name.rsplit(".", 3)[0] == document_filename
+    ]
+
+
+def cached_base64(file_path: Path) -> str:
+    """Return the base64 encoding of a document, reusing a local cache keyed on size and mtime.
+
+    Writing a new payload removes cached payloads for earlier versions of the same document.
+    """
+    stat = file_path.stat()
+    cache_file = _cached_payload_path(file_path, stat.st_size, stat.st_mtime_ns)
+    if cache_file.exists():
+        return cache_file.read_text(encoding="ascii")
+
+    encoded = base64.b64encode(file_path.read_bytes()).decode("ascii")
+    settings.document_cache_path.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        "w", encoding="ascii", dir=settings.document_cache_path, suffix=".tmp", delete=False
+    ) as tmp:
+        tmp.write(encoded)
+    Path(tmp.name).replace(cache_file)
+
+    for stale in _cached_payloads(file_path.name):
+        if stale != cache_file:
+            stale.unlink(missing_ok=True)
+    return encoded
+
+
+def _delete_provider_file(client: "anthropic.Anthropic", file_id: str) -> None:
+    """Delete an uploaded file from the provider, logging rather than raising on failure."""
+    import anthropic
+
+    try:
+        client.beta.files.delete(file_id, betas=[FILES_API_BETA])
+    except anthropic.APIError as e:
+        logger.warning("Could not delete provider file %s: %s", file_id, e)
+
+
+def _is_current(reference: dict | None, stat: os.stat_result) -> bool:
+    return bool(reference) and (reference["size"], reference["mtime_ns"]) == (
+        stat.st_size, stat.st_mtime_ns
+    )
+
+
+async def provider_file_id(client: "anthropic.Anthropic", file_path: Path) -> str:
+    """Return the provider file id for a document, uploading it if there is no current reference.
+
+    A stored reference is reused only while the local file's size and mtime still match; when
+    it is replaced, the previous upload is deleted from the provider.
+    """
+    stat = file_path.stat()
+    existing = await get_document_file(file_path.name)
+    if _is_current(existing, stat):
+        return existing["file_id"]
+
+    with file_path.open("rb") as fh:
+        uploaded = client.beta.files.upload(
+            file=(file_path.name, fh, "application/pdf"),
+            betas=[FILES_API_BETA],
+        )
+    await save_document_file(file_path.name, uploaded.id, stat.st_size, stat.st_mtime_ns)
+    if existing:
+        _delete_provider_file(client, existing["file_id"])
+    return uploaded.id
+
+
+async def pdf_content(client: "anthropic.Anthropic",
+                      file_path: Path) -> tuple[list[dict], bool]:
+    """Build the user content for a PDF.
+
+    Prefers a Files API reference; falls back to the cached base64 payload when the upload
+    fails. The second element is True when the content refers to an uploaded file.
+    """
+    import anthropic
+
+    try:
+        file_id = await provider_file_id(client, file_path)
+    except anthropic.APIError as e:
+        logger.warning("Files API upload failed for %s, sending inline: %s", file_path.name, e)
+    else:
+        return [{"type": "document", "source": {"type": "file", "file_id": file_id}}], True
+
+    return [
+        {
+            "type": "document",
+            "source": {
+                "type": "base64",
+                "media_type": "application/pdf",
+                "data": cached_base64(file_path),
+            },
+        },
+    ], False
+
+
+async def document_content(client: "anthropic.Anthropic",
+                           file_path: Path) -> tuple[list[dict], bool]:
+    """Build the user message content for any supported document type."""
+    if file_path.suffix.lower() == ".pdf":
+        return await pdf_content(client, file_path)
+    text_content = file_path.read_bytes().decode("utf-8", errors="replace")
+    return [{"type": "text", "text": text_content}], False
+
+
+def files_api_headers(user_content: list[dict]) -> dict[str, str]:
+    """Beta header for requests whose content refers to an uploaded file, else nothing."""
+    if any(block.get("source", {}).get("type") == "file" for block in user_content):
+        return {"anthropic-beta": FILES_API_BETA}
+    return {}
+
+
+def referenced_file_id(user_content: list[dict]) -> str | None:
+    for block in user_content:
+        source = block.get("source", {})
+        if source.get("type") == "file":
+            return source["file_id"]
+    return None
+
+
+def is_missing_file_error(error: "anthropic.NotFoundError", file_id: str) -> bool:
+    """True if a 404 is about the given uploaded file, not e.g. an unknown model."""
+    return file_id in str(error.body) or file_id in str(error)
+
+
+async def existing_document_content(file_path: Path) -> list[dict] | None:
+    """Build user content without side effects, or None if that would need an upload.
+
+    Text documents are read locally; PDFs are only usable through a current file reference.
+    """
+    if file_path.suffix.lower() != ".pdf":
+        return [{"type": "text", "text": file_path.read_bytes().decode("utf-8", errors="replace")}]
+    reference = await get_document_file(file_path.name)
+    if not _is_current(reference, file_path.stat()):
+        return None
+    return [{"type": "document", "source": {"type": "file", "file_id": reference["file_id"]}}]
+
+
+@lru_cache(maxsize=256)
+def _hash_file(path: str, size: int, mtime_ns: int) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        while chunk := fh.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def document_hash(file_path: Path) -> str:
+    """SHA-256 of a document's contents, memoised while its size and mtime are unchanged."""
+    stat = file_path.stat()
+    return _hash_file(str(file_path), stat.st_size, stat.st_mtime_ns)
+
+
+async def forget_document(client: "anthropic.Anthropic | None", document_filename: str) -> None:
+    """Drop the stored file reference and cached payloads for a document.
+
+    With a client, the uploaded file is also deleted from the provider.
+    """
+    existing = await get_document_file(document_filename)
+    await delete_document_file(document_filename)
+    if existing and client is not None:
+        _delete_provider_file(client, existing["file_id"])
+    for f in _cached_payloads(document_filename):
+        f.unlink(missing_ok=True)
@@ -0,0 +1,92 @@
+import csv
+import io
+import json
+from collections.abc import AsyncIterator, Iterable
+
+RUN_COLUMNS = [
+    "id", "prompt_id", "document_filename", "model", "status", "error_message", "duration_ms",
+    "input_tokens", "max_tokens", "stop_reason", "truncated", "created_at", "output",
+]
+
+CLAIM_COLUMNS = [
+    "run_id", "prompt_id", "document_filename", "model", "created_at",
+    "document_title", "company_name", "reporting_year",
+    "claim_id", "theme", "claim_type", "claim_text", "evidence",
+]
+
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+def parse_claim_map(output: str | None) -> dict | None:
+    """Parse a run's output as a claim map, tolerating a surrounding markdown code fence."""
+    if not output:
+        return None
+    text = output.strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[1] if "\n" in text else ""
+        text = text.rsplit("```", 1)[0]
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def claim_rows(run: dict) -> list[dict]:
+    """Flatten a run into one row per extracted claim. Unparseable output yields no rows."""
+    claim_map = parse_claim_map(run["output"])
+    if not claim_map:
+        return []
+    rows = []
+    for claim in claim_map.get("claims") or []:
+        if not isinstance(claim, dict):
+            continue
+        rows.append({
+            "run_id": run["id"],
+            "prompt_id": run["prompt_id"],
+            "document_filename": run["document_filename"],
+            "model": run["model"],
+            "created_at": run["created_at"],
+            "document_title": claim_map.get("document_title"),
+            "company_name": claim_map.get("company_name"),
+            "reporting_year": claim_map.get("reporting_year"),
+            "claim_id": claim.get("id"),
+            "theme": claim.get("theme"),
+            "claim_type": claim.get("claim_type"),
+            "claim_text": claim.get("claim_text"),
+            "evidence": claim.get("evidence") or [],
+        })
+    return rows
+
+
+def _ndjson(rows: Iterable[dict], columns: list[str]) -> str:
+    return "".join(json.dumps({c: row.get(c) for c in columns}) + "\n" for row in rows)
+
+
+def _csv(rows: Iterable[dict], columns: list[str], *, header: bool = False) -> str:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    if header:
+        writer.writerow(columns)
+    for row in rows:
+        writer.writerow([
+            json.dumps(v) if isinstance(v, (list, dict)) else v
+            for v in (row.get(c) for c in columns)
+        ])
+    return buf.getvalue()
+
+
+async def export_stream(batches: AsyncIterator[list[dict]], *, fmt: str,
+                        level: str) -> AsyncIterator[str]:
+    """Serialise batches of runs as NDJSON or CSV, one chunk per batch.
+
+    With level="claims" each run is expanded into its claim rows.
+    """
+    columns = CLAIM_COLUMNS if level == "claims" else RUN_COLUMNS
+    if fmt == "csv":
+        yield _csv([], columns, header=True)
+
+    async for runs in batches:
+        rows = [r for run in runs for r in claim_rows(run)] if level == "claims" else runs
+        if rows:
+            yield _csv(rows, columns) if fmt == "csv" else _ndjson(rows, columns)
@@ -1,4 +1,5 @@
 import logging
+import time
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
@@ -16,9 +17,12 @@ async def lifespan(app: FastAPI):
         level=getattr(logging, settings.log_level.upper(), logging.INFO),
         format="%(asctime)s %(levelname)s %(name)s: %(message)s",
     )
+    start = time.monotonic()
     settings.upload_path.mkdir(parents=True, exist_ok=True)
     await init_db()
-    logging.getLogger(__name__).info("SignalDrift backend starting up")
+    logging.getLogger(__name__).info(
+        "SignalDrift backend starting up (init took %d ms)", (time.monotonic() - start) * 1000
+    )
     yield
     logging.getLogger(__name__).info("SignalDrift backend shutting down")
 
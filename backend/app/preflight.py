@@ -0,0 +1,114 @@
+import hashlib
+import logging
+import re
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from app.config import settings
+from app.database import get_token_count, save_token_count
+from app.documents import document_hash, files_api_headers
+
+if TYPE_CHECKING:
+    import anthropic
+
+logger = logging.getLogger(__name__)
+
+# Rough fallbacks for when the token counting endpoint is unavailable.
+CHARS_PER_TOKEN = 4
+TOKENS_PER_PDF_PAGE = 3000
+
+_PDF_PAGE = re.compile(rb"/Type\s*/Page(?![a-zA-Z])")
+
+
+def prompt_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def estimate_input_tokens(system: str, file_path: Path) -> int:
+    """Heuristic input token estimate from prompt length and document size or page count."""
+    tokens = len(system) // CHARS_PER_TOKEN
+    if file_path.suffix.lower() == ".pdf":
+        pages = len(_PDF_PAGE.findall(file_path.read_bytes()))
+        return tokens + max(pages, 1) * TOKENS_PER_PDF_PAGE
+    return tokens + file_path.stat().st_size // CHARS_PER_TOKEN
+
+
+async def cached_input_tokens(system: str, file_path: Path) -> int | None:
+    """Return a previously counted input size for this prompt, document and model, if any."""
+    return await get_token_count(document_hash(file_path), prompt_hash(system),
+                                 settings.anthropic_model)
+
+
+async def count_input_tokens(client: "anthropic.Anthropic | None", system: str,
+                             file_path: Path, user_content: list[dict] | None) -> tuple[int, str]:
+    """Return (input_tokens, source) for a prompt and document.
+
+    Counts from the provider are cached per (document hash, prompt hash, model). Without a
+    client, or if counting fails, a heuristic estimate is returned and not cached.
+    """
+    cached = await cached_input_tokens(system, file_path)
+    if cached is not None:
+        return cached, "count"
+
+    if client is not None and user_content is not None:
+        import anthropic
+
+        try:
+            result = client.messages.count_tokens(
+                model=settings.anthropic_model,
+                system=system,
+                messages=[{"role": "user", "content": user_content}],
+                extra_headers=files_api_headers(user_content),
+            )
+        except anthropic.APIError as e:
+            logger.warning("Token count failed for %s, using estimate: %s", file_path.name, e)
+        else:
+            await save_token_count(document_hash(file_path), prompt_hash(system),
+                                   settings.anthropic_model, result.input_tokens)
+            return result.input_tokens, "count"
+
+    return estimate_input_tokens(system, file_path), "estimate"
+
+
+def plan_budget(input_tokens: int) -> dict | None:
+    """Pick a model and max_tokens that fit the input, or None if no model can take it.
+
+    Falls through to the long-context model, when configured, if the default is too small.
+    """
+    candidates = [(settings.anthropic_model, settings.context_window_tokens)]
+    if settings.long_context_model:
+        candidates.append((settings.long_context_model, settings.long_context_window_tokens))
+
+    for model, window in candidates:
+        available = window - input_tokens
+        if available >= settings.min_output_tokens:
+            return {"model": model, "max_tokens": min(settings.max_output_tokens, available)}
+    return None
+
+
+def _rates(model: str) -> tuple[float, float, float, float]:
+    """(input $/Mtok, output $/Mtok, input tok/s, output tok/s) for the model a run will use."""
+    if settings.long_context_model and model == settings.long_context_model:
+        return (settings.long_context_input_cost_per_mtok,
+                settings.long_context_output_cost_per_mtok,
+                settings.long_context_input_tokens_per_second,
+                settings.long_context_output_tokens_per_second)
+    return (settings.input_cost_per_mtok, settings.output_cost_per_mtok,
+            settings.input_tokens_per_second, settings.output_tokens_per_second)
+
+
+def cost_and_latency(model: str, input_tokens: int, max_tokens: int) -> dict:
+    """Upper-bound cost and latency on the given model, assuming the full output budget is used."""
+    input_cost, output_cost, input_tps, output_tps = _rates(model)
+    cost = (input_tokens * input_cost + max_tokens * output_cost) / 1_000_000
+    seconds = input_tokens / input_tps + max_tokens / output_tps
+    return {"max_cost_usd": round(cost, 4), "max_latency_ms": int(seconds * 1000)}
+
+
+def oversized_detail(input_tokens: int) -> str:
+    limit = max(settings.context_window_tokens,
+                settings.long_context_window_tokens if settings.long_context_model else 0)
+    return (
+        f"Document and prompt need about {input_tokens:,} input tokens, leaving less than "
+        f"{settings.min_output_tokens:,} output tokens within the {limit:,} token context window"
+    )
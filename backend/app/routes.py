@@ -1,10 +1,10 @@
-import base64
 import datetime
 import time
 from pathlib import Path
+from typing import TYPE_CHECKING, Literal
 
-import anthropic
 from fastapi import APIRouter, HTTPException, UploadFile
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
 from app.config import ALLOWED_EXTENSIONS, settings
@@ -13,10 +13,30 @@ from app.database import (
     create_run,
     get_prompt,
     get_run,
+    iter_runs,
     list_prompts,
     list_runs,
     update_run,
 )
+from app.documents import (
+    document_content,
+    existing_document_content,
+    files_api_headers,
+    forget_document,
+    is_missing_file_error,
+    referenced_file_id,
+)
+from app.exports import MEDIA_TYPES, export_stream
+from app.preflight import (
+    cached_input_tokens,
+    cost_and_latency,
+    count_input_tokens,
+    oversized_detail,
+    plan_budget,
+)
+
+if TYPE_CHECKING:
+    import anthropic
 
 router = APIRouter(prefix="/api/v1")
 
@@ -91,6 +111,8 @@ async def delete_document(filename: str) -> dict:
     if file_path.resolve().parent != settings.upload_path.resolve():
         raise HTTPException(status_code=400, detail="Invalid filename")
     file_path.unlink()
+    client = _client() if settings.anthropic_api_key else None
+    await forget_document(client, filename)
     return {"deleted": filename}
 
 
@@ -128,6 +150,45 @@ async def get_run_endpoint(run_id: str) -> dict:
     return run
 
 
+# -- Exports --
+
+def _utc_iso(value: datetime.datetime | None) -> str | None:
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.UTC)
+    return value.astimezone(datetime.UTC).isoformat()
+
+
+@router.get("/exports/runs")
+async def export_runs(
+    format: Literal["ndjson", "csv"] = "ndjson",
+    level: Literal["runs", "claims"] = "runs",
+    created_from: datetime.datetime | None = None,
+    created_to: datetime.datetime | None = None,
+    document_filename: str | None = None,
+    prompt_id: str | None = None,
+    status: str | None = None,
+) -> StreamingResponse:
+    """Stream runs, or one row per claim with level=claims, as NDJSON or CSV.
+
+    Rows are read through a server-side cursor and sent with chunked transfer encoding.
+    created_from is inclusive and created_to exclusive; naive datetimes are taken as UTC.
+    """
+    batches = iter_runs(
+        created_from=_utc_iso(created_from),
+        created_to=_utc_iso(created_to),
+        document_filename=document_filename,
+        prompt_id=prompt_id,
+        status=status,
+    )
+    return StreamingResponse(
+        export_stream(batches, fmt=format, level=level),
+        media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{level}.{format}"'},
+    )
+
+
 # -- Analyse --
 
 class AnalyseRequest(BaseModel):
@@ -135,9 +196,87 @@ class AnalyseRequest(BaseModel):
     document_filename: str
 
 
+def _client() -> "anthropic.Anthropic":
+    # Imported on first use: the SDK is the heaviest import in the app and only needed here.
+    import anthropic
+
+    return anthropic.Anthropic(
+        api_key=settings.anthropic_api_key,
+        base_url=settings.anthropic_base_url or None,
+    )
+
+
+def _create_message(client: "anthropic.Anthropic", system: str, user_content: list[dict],
+                    *, model: str, max_tokens: int):
+    return client.messages.create(
+        model=model,
+        max_tokens=max_tokens,
+        system=system,
+        messages=[{"role": "user", "content": user_content}],
+        extra_headers=files_api_headers(user_content),
+    )
+
+
+async def _fail_run(run: dict, prompt: dict, error_message: str) -> dict:
+    await update_run(run["id"], status="error", error_message=error_message)
+    run["status"] = "error"
+    run["error_message"] = error_message
+    run["prompt_text"] = prompt["text"]
+    return run
+
+
+@router.get("/documents/{filename}/estimate")
+async def estimate_document(filename: str, prompt_id: str) -> dict:
+    """Estimate input tokens, output budget, cost and latency for analysing a document.
+
+    Cost and latency use the rates of the model the run would be routed to.
+    """
+    prompt = await get_prompt(prompt_id)
+    if not prompt:
+        raise HTTPException(status_code=404, detail="Prompt not found")
+
+    file_path = settings.upload_path / filename
+    if not file_path.exists() or not file_path.is_file():
+        raise HTTPException(status_code=404, detail="Document not found")
+
+    # Read-only: reuse a cached count, or count with a reference the document already has.
+    # Never upload or write cache files here; without either, fall back to the heuristic.
+    input_tokens = await cached_input_tokens(prompt["text"], file_path)
+    token_source = "count"
+    if input_tokens is None:
+        client, user_content = None, None
+        if settings.anthropic_api_key:
+            client = _client()
+            user_content = await existing_document_content(file_path)
+        input_tokens, token_source = await count_input_tokens(
+            client, prompt["text"], file_path, user_content
+        )
+
+    estimate = {
+        "document_filename": filename,
+        "prompt_id": prompt_id,
+        "input_tokens": input_tokens,
+        "token_source": token_source,
+        "fits": False,
+        "model": None,
+        "max_tokens": None,
+        "max_cost_usd": None,
+        "max_latency_ms": None,
+    }
+    budget = plan_budget(input_tokens)
+    if budget:
+        estimate.update(budget, fits=True)
+        estimate.update(cost_and_latency(budget["model"], input_tokens, budget["max_tokens"]))
+    return estimate
+
+
 @router.post("/analyse", status_code=201)
 async def analyse_document(body: AnalyseRequest) -> dict:
-    """Run LLM analysis on a document with a given prompt."""
+    """Run LLM analysis on a document with a given prompt.
+
+    A pre-flight token count picks the model and max_tokens, and rejects inputs that do not fit.
+    Inputs are only rejected on a provider count, never on the heuristic estimate.
+    """
     if not settings.anthropic_api_key:
         raise HTTPException(status_code=500, detail="ANTHROPIC_API_KEY not configured")
 
@@ -149,49 +288,61 @@ async def analyse_document(body: AnalyseRequest) -> dict:
     if not file_path.exists() or not file_path.is_file():
         raise HTTPException(status_code=404, detail="Document not found")
 
-    run = await create_run(body.prompt_id, body.document_filename, settings.anthropic_model)
+    import anthropic
 
     try:
-        client = anthropic.Anthropic(api_key=settings.anthropic_api_key)
-        file_bytes = file_path.read_bytes()
-        ext = file_path.suffix.lower()
-
-        if ext == ".pdf":
-            user_content = [
-                {
-                    "type": "document",
-                    "source": {
-                        "type": "base64",
-                        "media_type": "application/pdf",
-                        "data": base64.b64encode(file_bytes).decode("ascii"),
-                    },
-                },
-            ]
-        else:
-            text_content = file_bytes.decode("utf-8", errors="replace")
-            user_content = [{"type": "text", "text": text_content}]
+        client = _client()
+        user_content, _ = await document_content(client, file_path)
+        input_tokens, token_source = await count_input_tokens(
+            client, prompt["text"], file_path, user_content
+        )
+    except Exception as e:
+        run = await create_run(body.prompt_id, body.document_filename, settings.anthropic_model)
+        return await _fail_run(run, prompt, f"Pre-flight failed: {e}")
+
+    budget = plan_budget(input_tokens)
+    if not budget:
+        if token_source == "count":
+            raise HTTPException(status_code=413, detail=oversized_detail(input_tokens))
+        # Only a heuristic guess says it won't fit; let the provider decide rather than reject.
+        budget = {"model": settings.anthropic_model, "max_tokens": settings.max_output_tokens}
+
+    run = await create_run(body.prompt_id, body.document_filename, budget["model"],
+                           input_tokens=input_tokens, max_tokens=budget["max_tokens"])
 
+    try:
         start = time.monotonic()
-        response = client.messages.create(
-            model=settings.anthropic_model,
-            max_tokens=8192,
-            system=prompt["text"],
-            messages=[{"role": "user", "content": user_content}],
-        )
+        try:
+            response = _create_message(client, prompt["text"], user_content, **budget)
+        except anthropic.NotFoundError as e:
+            file_id = referenced_file_id(user_content)
+            if not file_id or not is_missing_file_error(e, file_id):
+                raise
+            # The provider no longer has the stored file id; drop it, upload again and retry once.
+            await forget_document(client, body.document_filename)
+            user_content, _ = await document_content(client, file_path)
+            response = _create_message(client, prompt["text"], user_content, **budget)
         duration_ms = int((time.monotonic() - start) * 1000)
 
         output_text = response.content[0].text if response.content else ""
+        stop_reason = response.stop_reason
+        truncated = stop_reason == "max_tokens"
+        error_message = (
+            f"Output truncated at max_tokens={budget['max_tokens']}" if truncated else None
+        )
 
-        await update_run(run["id"], status="complete", output=output_text, duration_ms=duration_ms)
+        await update_run(run["id"], status="complete", output=output_text,
+                         error_message=error_message, duration_ms=duration_ms,
+                         stop_reason=stop_reason, truncated=truncated)
         run["status"] = "complete"
         run["output"] = output_text
+        run["error_message"] = error_message
         run["duration_ms"] = duration_ms
+        run["stop_reason"] = stop_reason
+        run["truncated"] = int(truncated)
         run["prompt_text"] = prompt["text"]
 
     except Exception as e:
-        await update_run(run["id"], status="error", error_message=str(e))
-        run["status"] = "error"
-        run["error_message"] = str(e)
-        run["prompt_text"] = prompt["text"]
+        return await _fail_run(run, prompt, str(e))
 
     return run
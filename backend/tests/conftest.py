@@ -1,4 +1,5 @@
 import asyncio
+from unittest.mock import MagicMock, patch
 
 import pytest
 from fastapi.testclient import TestClient
@@ -27,3 +28,31 @@ def client():
     """Yield a TestClient instance for the FastAPI app."""
     with TestClient(app) as c:
         yield c
+
+
+@pytest.fixture
+def api_key(monkeypatch):
+    """Configure a dummy Anthropic API key for the duration of a test."""
+    monkeypatch.setattr(settings, "anthropic_api_key", "test-key")
+
+
+@pytest.fixture
+def mock_anthropic(api_key):
+    """Patch the Anthropic client and yield the mock instance the app will use.
+
+    Token counting returns 1200 tokens and messages complete with a stub claim map.
+    """
+    mock_client = MagicMock()
+    mock_client.messages.count_tokens.return_value = MagicMock(input_tokens=1200)
+    mock_client.messages.create.return_value = mock_message()
+    with patch("anthropic.Anthropic", return_value=mock_client):
+        yield mock_client
+
+
+def mock_message(text='{"claims": []}', stop_reason="end_turn"):
+    mock_response = MagicMock()
+    mock_content = MagicMock()
+    mock_content.text = text
+    mock_response.content = [mock_content]
+    mock_response.stop_reason = stop_reason
+    return mock_response
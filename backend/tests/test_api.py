@@ -1,5 +1,10 @@
+import asyncio
 from unittest.mock import MagicMock, patch
 
+import pytest
+
+from tests.conftest import mock_message
+
 
 def test_health_returns_ok(client):
     response = client.get("/api/v1/health")
@@ -150,9 +155,11 @@ def test_analyse_with_mocked_anthropic(client):
         mock_content = MagicMock()
         mock_content.text = '{"claims": []}'
         mock_response.content = [mock_content]
+        mock_response.stop_reason = "end_turn"
 
-        with patch("app.routes.anthropic.Anthropic") as mock_cls:
+        with patch("anthropic.Anthropic") as mock_cls:
             mock_client = MagicMock()
+            mock_client.messages.count_tokens.return_value = MagicMock(input_tokens=1200)
             mock_client.messages.create.return_value = mock_response
             mock_cls.return_value = mock_client
 
@@ -177,3 +184,563 @@ def test_analyse_with_mocked_anthropic(client):
         assert len(runs) == 1
     finally:
         settings.anthropic_api_key = original_key
+
+
+# -- Provider file references --
+
+def _upload_pdf(client):
+    return client.post(
+        "/api/v1/documents",
+        files={"file": ("report.pdf", b"%PDF-1.4 fake", "application/pdf")},
+    ).json()["filename"]
+
+
+def _analyse(client, filename):
+    prompt_id = client.get("/api/v1/prompts").json()["prompts"][0]["id"]
+    return client.post("/api/v1/analyse", json={
+        "prompt_id": prompt_id,
+        "document_filename": filename,
+    })
+
+
+def _not_found(message):
+    import anthropic
+    import httpx
+
+    request = httpx.Request("POST", "http://files.local/v1/messages")
+    return anthropic.NotFoundError(
+        message, response=httpx.Response(404, request=request),
+        body={"type": "error", "error": {"type": "not_found_error", "message": message}},
+    )
+
+
+def _connection_error():
+    import anthropic
+    import httpx
+
+    return anthropic.APIConnectionError(request=httpx.Request("POST", "http://files.local/v1/files"))
+
+
+def _sent_content(mock_client):
+    return mock_client.messages.create.call_args.kwargs["messages"][0]["content"]
+
+
+def test_analyse_pdf_uploads_once_and_reuses_file_id(client, mock_anthropic):
+    mock_anthropic.beta.files.upload.return_value = MagicMock(id="file_abc")
+    filename = _upload_pdf(client)
+
+    for _ in range(2):
+        assert _analyse(client, filename).json()["status"] == "complete"
+
+    assert mock_anthropic.beta.files.upload.call_count == 1
+    assert _sent_content(mock_anthropic) == [
+        {"type": "document", "source": {"type": "file", "file_id": "file_abc"}}
+    ]
+
+
+def test_analyse_pdf_reuploads_stale_file_id(client, mock_anthropic):
+    from app.config import settings
+    from app.database import save_document_file
+
+    filename = _upload_pdf(client)
+    stat = (settings.upload_path / filename).stat()
+    asyncio.run(save_document_file(filename, "file_stale", stat.st_size, stat.st_mtime_ns))
+    mock_anthropic.beta.files.upload.return_value = MagicMock(id="file_fresh")
+    mock_anthropic.messages.create.side_effect = [
+        _not_found("File not found: file_stale"), mock_message()
+    ]
+
+    assert _analyse(client, filename).json()["status"] == "complete"
+    assert mock_anthropic.beta.files.upload.call_count == 1
+    assert _sent_content(mock_anthropic)[0]["source"]["file_id"] == "file_fresh"
+
+
+def test_analyse_retries_missing_file_only_once_and_deletes_old_id(client, mock_anthropic):
+    mock_anthropic.beta.files.upload.side_effect = [
+        MagicMock(id="file_v1"), MagicMock(id="file_v2")
+    ]
+
+    def missing_file(**kwargs):
+        file_id = kwargs["messages"][0]["content"][0]["source"]["file_id"]
+        raise _not_found(f"File not found: {file_id}")
+
+    mock_anthropic.messages.create.side_effect = missing_file
+
+    response = _analyse(client, _upload_pdf(client))
+
+    assert response.json()["status"] == "error"
+    assert mock_anthropic.beta.files.upload.call_count == 2
+    assert mock_anthropic.messages.create.call_count == 2
+    assert mock_anthropic.beta.files.delete.call_args.args == ("file_v1",)
+
+
+def test_analyse_does_not_reupload_on_unrelated_not_found(client, mock_anthropic):
+    mock_anthropic.beta.files.upload.return_value = MagicMock(id="file_abc")
+    mock_anthropic.messages.create.side_effect = _not_found("model: no-such-model")
+
+    response = _analyse(client, _upload_pdf(client))
+
+    assert response.json()["status"] == "error"
+    assert mock_anthropic.beta.files.upload.call_count == 1
+    mock_anthropic.beta.files.delete.assert_not_called()
+
+
+def test_analyse_pdf_falls_back_to_cached_base64(client, mock_anthropic):
+    from app.config import settings
+
+    mock_anthropic.beta.files.upload.side_effect = _connection_error()
+    filename = _upload_pdf(client)
+
+    assert _analyse(client, filename).json()["status"] == "complete"
+    assert _sent_content(mock_anthropic)[0]["source"]["type"] == "base64"
+    assert mock_anthropic.messages.create.call_args.kwargs["extra_headers"] == {}
+    assert len(list(settings.document_cache_path.glob("*.b64"))) == 1
+
+    client.delete(f"/api/v1/documents/{filename}")
+    assert list(settings.document_cache_path.glob("*.b64")) == []
+
+
+def test_files_api_beta_header_only_sent_with_file_references(client, mock_anthropic):
+    mock_anthropic.beta.files.upload.return_value = MagicMock(id="file_abc")
+    _analyse(client, _upload_pdf(client))
+    assert mock_anthropic.messages.create.call_args.kwargs["extra_headers"] == {
+        "anthropic-beta": "files-api-2025-04-14"
+    }
+    assert mock_anthropic.messages.count_tokens.call_args.kwargs["extra_headers"] == {
+        "anthropic-beta": "files-api-2025-04-14"
+    }
+
+    _analyse(client, _upload_txt(client))
+    assert mock_anthropic.messages.create.call_args.kwargs["extra_headers"] == {}
+    assert mock_anthropic.messages.count_tokens.call_args.kwargs["extra_headers"] == {}
+
+
+def test_reupload_of_changed_pdf_deletes_previous_provider_file(client, mock_anthropic):
+    import os
+
+    from app.config import settings
+
+    mock_anthropic.beta.files.upload.side_effect = [
+        MagicMock(id="file_v1"), MagicMock(id="file_v2")
+    ]
+    filename = _upload_pdf(client)
+    _analyse(client, filename)
+
+    path = settings.upload_path / filename
+    path.write_bytes(b"%PDF-1.4 revised")
+    os.utime(path, ns=(path.stat().st_atime_ns, path.stat().st_mtime_ns + 1_000_000))
+    _analyse(client, filename)
+
+    mock_anthropic.beta.files.delete.assert_called_once()
+    assert mock_anthropic.beta.files.delete.call_args.args == ("file_v1",)
+    assert _sent_content(mock_anthropic)[0]["source"]["file_id"] == "file_v2"
+
+
+def test_delete_document_deletes_provider_file(client, mock_anthropic):
+    mock_anthropic.beta.files.upload.return_value = MagicMock(id="file_abc")
+    filename = _upload_pdf(client)
+    _analyse(client, filename)
+
+    assert client.delete(f"/api/v1/documents/{filename}").status_code == 200
+    assert mock_anthropic.beta.files.delete.call_args.args == ("file_abc",)
+
+
+def test_delete_document_survives_provider_delete_failure(client, mock_anthropic):
+    mock_anthropic.beta.files.upload.return_value = MagicMock(id="file_abc")
+    mock_anthropic.beta.files.delete.side_effect = _connection_error()
+    filename = _upload_pdf(client)
+    _analyse(client, filename)
+
+    assert client.delete(f"/api/v1/documents/{filename}").status_code == 200
+
+
+def test_cached_base64_prunes_outdated_payloads(client):
+    import os
+
+    from app.config import settings
+    from app.documents import cached_base64
+
+    filename = _upload_pdf(client)
+    path = settings.upload_path / filename
+    cached_base64(path)
+    path.write_bytes(b"%PDF-1.4 revised")
+    os.utime(path, ns=(path.stat().st_atime_ns, path.stat().st_mtime_ns + 1_000_000))
+    cached_base64(path)
+
+    stat = path.stat()
+    cached = [f.name for f in settings.document_cache_path.iterdir()]
+    assert cached == [f"{filename}.{stat.st_size}.{stat.st_mtime_ns}.b64"]
+
+
+# -- Pre-flight budgeting --
+
+def _upload_txt(client, content=b"ESG report content here"):
+    return client.post(
+        "/api/v1/documents",
+        files={"file": ("report.txt", content, "text/plain")},
+    ).json()["filename"]
+
+
+def _estimate(client, filename):
+    prompt_id = client.get("/api/v1/prompts").json()["prompts"][0]["id"]
+    return client.get(f"/api/v1/documents/{filename}/estimate?prompt_id={prompt_id}")
+
+
+def test_estimate_without_api_key_uses_heuristic(client, monkeypatch):
+    from app.config import settings
+
+    monkeypatch.setattr(settings, "anthropic_api_key", "")
+    filename = _upload_txt(client, b"x" * 4000)
+
+    response = _estimate(client, filename)
+    assert response.status_code == 200
+    data = response.json()
+    assert data["token_source"] == "estimate"
+    assert data["input_tokens"] >= 1000
+    assert data["fits"] is True
+    assert data["model"] == settings.anthropic_model
+    assert data["max_tokens"] == settings.max_output_tokens
+    assert data["max_cost_usd"] > 0
+    assert data["max_latency_ms"] > 0
+
+
+def test_estimate_prices_long_context_model_at_its_own_rates(client, monkeypatch):
+    from app.config import settings
+
+    monkeypatch.setattr(settings, "anthropic_api_key", "")
+    monkeypatch.setattr(settings, "long_context_model", "long-context-model")
+    input_tokens = settings.context_window_tokens
+    filename = _upload_txt(client, b"x" * input_tokens * 4)
+
+    data = _estimate(client, filename).json()
+
+    assert data["model"] == "long-context-model"
+    expected_cost = (data["input_tokens"] * settings.long_context_input_cost_per_mtok
+                     + data["max_tokens"] * settings.long_context_output_cost_per_mtok) / 1_000_000
+    assert data["max_cost_usd"] == round(expected_cost, 4)
+
+
+def test_estimate_unknown_prompt_returns_404(client):
+    filename = _upload_txt(client)
+    response = client.get(f"/api/v1/documents/{filename}/estimate?prompt_id=missing")
+    assert response.status_code == 404
+
+
+def test_analyse_caches_token_count_and_sizes_max_tokens(client, mock_anthropic):
+    from app.config import settings
+
+    input_tokens = settings.context_window_tokens - 2000
+    mock_anthropic.messages.count_tokens.return_value = MagicMock(input_tokens=input_tokens)
+    filename = _upload_txt(client)
+
+    for _ in range(2):
+        response = _analyse(client, filename)
+
+    assert mock_anthropic.messages.count_tokens.call_count == 1
+    assert mock_anthropic.messages.create.call_args.kwargs["max_tokens"] == 2000
+    data = response.json()
+    assert data["input_tokens"] == input_tokens
+    assert data["max_tokens"] == 2000
+
+
+def test_analyse_rejects_oversized_input(client, mock_anthropic):
+    from app.config import settings
+
+    mock_anthropic.messages.count_tokens.return_value = MagicMock(
+        input_tokens=settings.context_window_tokens
+    )
+    response = _analyse(client, _upload_txt(client))
+
+    assert response.status_code == 413
+    assert "input tokens" in response.json()["detail"]
+    mock_anthropic.messages.create.assert_not_called()
+    assert client.get("/api/v1/runs").json() == {"runs": []}
+
+
+def _upload_multipage_pdf(client, pages):
+    body = b"%PDF-1.4\n" + b"".join(b"<< /Type /Page >>\n" for _ in range(pages))
+    return client.post(
+        "/api/v1/documents",
+        files={"file": ("long.pdf", body, "application/pdf")},
+    ).json()["filename"]
+
+
+def test_analyse_runs_when_count_fails_and_estimate_is_oversized(client, mock_anthropic):
+    from app.config import settings
+
+    mock_anthropic.beta.files.upload.return_value = MagicMock(id="file_abc")
+    mock_anthropic.messages.count_tokens.side_effect = _connection_error()
+
+    response = _analyse(client, _upload_multipage_pdf(client, 70))
+
+    assert response.status_code == 201
+    data = response.json()
+    assert data["status"] == "complete"
+    assert data["input_tokens"] > settings.context_window_tokens
+    assert mock_anthropic.messages.create.call_args.kwargs["max_tokens"] == (
+        settings.max_output_tokens
+    )
+
+
+def test_analyse_recovers_stale_file_when_count_also_404s(client, mock_anthropic):
+    from app.config import settings
+    from app.database import save_document_file
+
+    filename = _upload_multipage_pdf(client, 70)
+    stat = (settings.upload_path / filename).stat()
+    asyncio.run(save_document_file(filename, "file_stale", stat.st_size, stat.st_mtime_ns))
+    mock_anthropic.beta.files.upload.return_value = MagicMock(id="file_fresh")
+    mock_anthropic.messages.count_tokens.side_effect = _not_found("File not found: file_stale")
+    mock_anthropic.messages.create.side_effect = [
+        _not_found("File not found: file_stale"), mock_message()
+    ]
+
+    response = _analyse(client, filename)
+
+    assert response.json()["status"] == "complete"
+    assert _sent_content(mock_anthropic)[0]["source"]["file_id"] == "file_fresh"
+
+
+def test_analyse_routes_oversized_input_to_long_context_model(client, mock_anthropic, monkeypatch):
+    from app.config import settings
+
+    monkeypatch.setattr(settings, "long_context_model", "long-context-model")
+    mock_anthropic.messages.count_tokens.return_value = MagicMock(
+        input_tokens=settings.context_window_tokens
+    )
+    response = _analyse(client, _upload_txt(client))
+
+    assert response.json()["model"] == "long-context-model"
+    assert mock_anthropic.messages.create.call_args.kwargs["model"] == "long-context-model"
+
+
+def test_analyse_flags_truncated_output(client, mock_anthropic):
+    mock_anthropic.messages.create.return_value = mock_message(stop_reason="max_tokens")
+    response = _analyse(client, _upload_txt(client))
+
+    run = client.get(f"/api/v1/runs/{response.json()['id']}").json()
+    assert run["status"] == "complete"
+    assert run["stop_reason"] == "max_tokens"
+    assert run["truncated"] == 1
+    assert "truncated" in run["error_message"]
+
+
+def test_estimate_does_not_upload_or_cache_new_pdf(client, mock_anthropic):
+    from app.config import settings
+
+    response = _estimate(client, _upload_pdf(client))
+
+    assert response.json()["token_source"] == "estimate"
+    mock_anthropic.beta.files.upload.assert_not_called()
+    mock_anthropic.messages.count_tokens.assert_not_called()
+    assert not settings.document_cache_path.exists()
+
+
+def test_estimate_counts_with_existing_file_reference(client, mock_anthropic):
+    mock_anthropic.beta.files.upload.return_value = MagicMock(id="file_abc")
+    # Counting fails during analyse, so the estimate has no cached count to fall back on.
+    mock_anthropic.messages.count_tokens.side_effect = [
+        _connection_error(), MagicMock(input_tokens=900)
+    ]
+    filename = _upload_pdf(client)
+    _analyse(client, filename)
+
+    data = _estimate(client, filename).json()
+
+    assert data["token_source"] == "count"
+    assert data["input_tokens"] == 900
+    assert mock_anthropic.beta.files.upload.call_count == 1
+    messages = mock_anthropic.messages.count_tokens.call_args.kwargs["messages"]
+    assert messages[0]["content"][0]["source"] == {"type": "file", "file_id": "file_abc"}
+
+
+def test_estimate_reuses_cached_count(client, mock_anthropic):
+    filename = _upload_txt(client)
+    _analyse(client, filename)
+
+    data = _estimate(client, filename).json()
+
+    assert data["token_source"] == "count"
+    assert data["input_tokens"] == 1200
+    assert mock_anthropic.messages.count_tokens.call_count == 1
+
+
+def test_analyse_records_preflight_failure_as_error_run(client, mock_anthropic):
+    mock_anthropic.beta.files.upload.side_effect = OSError("disk read failed")
+    response = _analyse(client, _upload_pdf(client))
+
+    assert response.status_code == 201
+    data = response.json()
+    assert data["status"] == "error"
+    assert "disk read failed" in data["error_message"]
+    mock_anthropic.messages.create.assert_not_called()
+    assert client.get(f"/api/v1/runs/{data['id']}").json()["status"] == "error"
+
+
+# -- Exports --
+
+CLAIM_MAP = """```json
+{"document_title": "ESG Report", "company_name": "Acme", "reporting_year": "2024",
+ "claims": [
+   {"id": "C001", "theme": "Targets and commitments", "claim_type": "target",
+    "claim_text": "Net zero by 2040.",
+    "evidence": [{"quote": "net zero by 2040", "page_number": 3}]},
+   {"id": "C002", "theme": "Metrics and performance", "claim_type": "metric",
+    "claim_text": "Emissions fell 10%.", "evidence": []}
+ ]}
+```"""
+
+
+def _seed_runs():
+    from app.database import create_run, list_prompts, update_run
+
+    async def seed():
+        prompt_id = (await list_prompts())[0]["id"]
+        done = await create_run(prompt_id, "a.pdf", "test-model")
+        await update_run(done["id"], status="complete", output=CLAIM_MAP, duration_ms=10)
+        failed = await create_run(prompt_id, "b.pdf", "test-model")
+        await update_run(failed["id"], status="error", error_message="boom")
+        return done, failed
+
+    return asyncio.run(seed())
+
+
+def test_export_runs_ndjson(client):
+    import json
+    done, failed = _seed_runs()
+
+    with client.stream("GET", "/api/v1/exports/runs") as response:
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+        lines = [json.loads(line) for line in response.iter_lines() if line]
+
+    assert [r["id"] for r in lines] == [done["id"], failed["id"]]
+    assert lines[1]["error_message"] == "boom"
+
+
+def test_export_runs_filters(client):
+    import json
+    done, _ = _seed_runs()
+
+    response = client.get("/api/v1/exports/runs?status=complete&document_filename=a.pdf")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [r["id"] for r in lines] == [done["id"]]
+
+    response = client.get("/api/v1/exports/runs?created_from=2100-01-01T00:00:00")
+    assert response.text == ""
+
+
+def test_export_claims_csv(client):
+    import csv
+    import io
+    done, _ = _seed_runs()
+
+    response = client.get("/api/v1/exports/runs?format=csv&level=claims")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    rows = list(csv.DictReader(io.StringIO(response.text)))
+
+    assert [r["claim_id"] for r in rows] == ["C001", "C002"]
+    assert rows[0]["run_id"] == done["id"]
+    assert rows[0]["company_name"] == "Acme"
+    assert rows[0]["evidence"].startswith("[{")
+
+
+def test_export_streams_in_batches():
+    from app.database import iter_runs
+    from app.exports import export_stream
+    _seed_runs()
+
+    async def collect():
+        batches = iter_runs(batch_size=1)
+        return [chunk async for chunk in export_stream(batches, fmt="ndjson", level="runs")]
+
+    assert len(asyncio.run(collect())) == 2
+
+
+def test_export_rejects_unknown_format(client):
+    response = client.get("/api/v1/exports/runs?format=xml")
+    assert response.status_code == 422
+
+
+# -- Migrations and startup --
+
+def test_init_db_records_schema_version(client):
+    import sqlite3
+
+    from app.database import MIGRATIONS, _db_path
+
+    with sqlite3.connect(_db_path()) as conn:
+        versions = [r[0] for r in conn.execute("SELECT version FROM schema_version ORDER BY 1")]
+    assert versions == [v for v, _, _ in MIGRATIONS]
+
+
+def test_init_db_upgrades_unversioned_database(tmp_path):
+    import sqlite3
+
+    from app.config import settings
+    from app.database import MIGRATIONS, init_db
+
+    settings.db_path = str(tmp_path / "legacy.db")
+    with sqlite3.connect(settings.db_path) as conn:
+        conn.executescript("""
+            CREATE TABLE prompts (
+                id TEXT PRIMARY KEY, text TEXT NOT NULL, created_at TEXT NOT NULL
+            );
+            CREATE TABLE runs (
+                id TEXT PRIMARY KEY, prompt_id TEXT NOT NULL REFERENCES prompts(id),
+                document_filename TEXT NOT NULL, model TEXT NOT NULL, output TEXT,
+                status TEXT NOT NULL DEFAULT 'pending', error_message TEXT, duration_ms INTEGER,
+                created_at TEXT NOT NULL
+            );
+            INSERT INTO prompts VALUES ('p1', 'Existing prompt', '2025-01-01T00:00:00+00:00');
+        """)
+
+    async def start_workers():
+        await asyncio.gather(init_db(), init_db(), init_db())
+
+    asyncio.run(start_workers())
+
+    with sqlite3.connect(settings.db_path) as conn:
+        versions = [r[0] for r in conn.execute("SELECT version FROM schema_version ORDER BY 1")]
+        columns = {r[1] for r in conn.execute("PRAGMA table_info(runs)")}
+        prompts = conn.execute("SELECT id FROM prompts").fetchall()
+    assert versions == [v for v, _, _ in MIGRATIONS]
+    assert {"input_tokens", "max_tokens", "stop_reason", "truncated"} <= columns
+    assert prompts == [("p1",)]
+
+
+def _measure_app_import() -> dict:
+    """Import app.main in a fresh interpreter; report wall time and whether the SDK loaded."""
+    import json
+    import subprocess
+    import sys
+    from pathlib import Path
+
+    script = (
+        "import json, sys, time\n"
+        "start = time.perf_counter()\n"
+        "import app.main\n"
+        "print(json.dumps({'seconds': time.perf_counter() - start,"
+        " 'anthropic': 'anthropic' in sys.modules}))\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=Path(__file__).resolve().parent.parent,
+        capture_output=True, text=True, check=True,
+    )
+    return json.loads(result.stdout)
+
+
+def test_app_import_skips_provider_sdk():
+    assert _measure_app_import()["anthropic"] is False
+
+
+# Measured at ~0.7s locally once the provider SDK was made lazy (it alone cost ~1.7s).
+# Wall-clock timing is noisy on shared runners, so this only runs via `make test-startup`.
+STARTUP_IMPORT_BUDGET_S = 1.5
+
+
+@pytest.mark.startup_budget
+def test_app_import_within_startup_budget():
+    assert _measure_app_import()["seconds"] < STARTUP_IMPORT_BUDGET_S